@@ -25,10 +25,15 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 Module dependencies
 """
 import sys
+import re
 import string
 import subprocess
+import shlex
 import os.path
+import shutil
+import functools
 import tempfile
+import concurrent.futures
 
 """
 Global declarations
@@ -53,6 +58,9 @@ diffViewers = [ \
         "opendiff", \
         ]
 
+# The program names of the diff viewers, without switches
+diffViewerNames = tuple((s.split())[0] for s in diffViewers)
+
 # pdftotext program with switches
 pdftotextProgram = "pdftotext"
 pdftotextOptions = "-nopgbrk -enc UTF-8"
@@ -102,23 +110,54 @@ The code is split into five sections:
 # 1. Basics
 #-------------------------------------------------------------------------
 
-def get_viewer_list():
+def is_command_available(prg):
     """
-    Return the list of viewers
+    Detect whether prg exists. Note that it may have switches, i.e. 
+    it will find "kdiff3 -a"
     """
-    global diffViewers
+    return is_program_available((prg.split())[0])
 
-    return map(lambda s:(s.split())[0], diffViewers)
 
+@functools.lru_cache(maxsize=None)
+def is_program_available(name):
+    """
+    Detect whether the program name is on the path. We ask for the same
+    programs repeatedly, so the answers are cached.
+    """
+    return shutil.which(name) is not None
 
-def is_command_available(prg):
+
+def get_output(argv):
     """
-    Detect whether prg exists. Note that it may have switches, i.e. 
-    it will find "kdiff3 -a"
+    Run the command given as an argument list, without going through a
+    shell, and return its output (stdout and stderr), like
+    subprocess.getoutput does.
     """
-    cmd = "which %s" % ((prg.split())[0])
-    status, out = subprocess.getstatusoutput(cmd)
-    return (status == 0)
+    (status,output) = get_status_output(argv)
+    return output
+
+
+def get_status_output(argv):
+    """
+    Like get_output, but returns (exitstatus,output), like
+    subprocess.getstatusoutput does.
+    """
+    proc = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    output = proc.stdout
+    if output.endswith("\n"):
+        output = output[:-1]
+    return (proc.returncode,output)
+
+
+def conversion_failed(prg,filename,status,output):
+    """
+    Report that prg failed on (the conversion of) filename, showing what
+    it had to say about it, and exit.
+    """
+    if output != "":
+        print(output)
+    print("Error: %s failed to convert '%s' (exit status %d)" % (prg,filename,status))
+    sys.exit(1)
 
 
 def find_first(plist):
@@ -131,10 +170,11 @@ def find_first(plist):
     return None
 
 
-def apply_command_temp(prg,options,notfound,filename,prefix="",suffix=""):
+def apply_command_temp(prg,options,notfound,filename,prefix="",suffix="",origname=None):
     """
     Execute 'prg options filename tempout' if prg exists.
-    Report 'notfound' if prg is not there.
+    Report 'notfound' if prg is not there, and report a failure of prg
+    for origname (the file the user gave, defaults to filename).
 
     Returns (tempfileFilehandle,output) tuple.
     """
@@ -144,8 +184,10 @@ def apply_command_temp(prg,options,notfound,filename,prefix="",suffix=""):
         print("Error: %s" % notfound)
         sys.exit(1)
 
-    cmd = "%s %s \"%s\" \"%s\"" % (prg,options,filename,fout.name)
-    output = subprocess.getoutput(cmd)
+    argv = shlex.split(prg) + shlex.split(options) + [filename,fout.name]
+    (status,output) = get_status_output(argv)
+    if status != 0:
+        conversion_failed(prg,origname or filename,status,output)
     return (fout,output)
 
 
@@ -158,15 +200,37 @@ def make_prefix(fname):
     return root + "_"
 
 
+# File name extensions that we trust without asking 'file'
+knownExtensions = {"pdf":"pdf", "fdf":"pdf", "ps":"ps", "txt":"txt"}
+
+
 def get_filetype(filename):
     """
     Determine the filetype.
     """
+    if not os.path.exists(filename):
+        print("Error: Could not find the file '%s'" % filename)
+        sys.exit(1)
+
+    (root,ext) = os.path.splitext(filename)
+    ext = ext.lower().lstrip(".")
+    if ext in knownExtensions:
+        # No need to run 'file' for the common cases
+        return knownExtensions[ext]
+    return detect_filetype(filename,os.path.getmtime(filename))
+
+
+@functools.lru_cache(maxsize=128)
+def detect_filetype(filename,mtime):
+    """
+    Determine the filetype from the contents, if possible. The
+    modification time is only there to make the cached result
+    specific to this version of the file.
+    """
     if is_command_available("file"):
         # On systems where we have 'file', this is a nice
         # and solid solution.
-        cmd = "file --brief \"%s\"" % filename
-        output = subprocess.getoutput(cmd)
+        output = get_output(["file","--brief",filename])
         type = (output.split())[0].lower()
     else:
         # If we don't have 'file', we just take an educated
@@ -190,131 +254,167 @@ def get_filetype(filename):
         return "txt"
 
 
+# Translation table for the 'ff' ligatures (ffi, ffl, ff), see
+# fix_ff_problem. We use escapes, as this file is read as latin-1.
+ligatureTable = str.maketrans({"\ufb03":"ffi", "\ufb04":"ffl", "\ufb00":"ff"})
+
+
 def fix_ff_problem(sentence):
     """
     Hack to fix an often occurring latex problem with 'ff' combinations.
     This is ultimately a font problem (with Times New Roman), and not our
     problem (probably latex, alternatively pdftotext ought to fix it).
-    For now, we just stupidly revert the weird character combos.
+    For now, we just stupidly revert the weird character combos, in a
+    single pass over the sentence.
     """
-    sentence = sentence.replace("ﬃ","ffi")
-    sentence = sentence.replace("ﬄ","ffl")
-    sentence = sentence.replace("ﬀ","ff")
-    return sentence
+    return sentence.translate(ligatureTable)
 
 
 #-------------------------------------------------------------------------
 # 2. Text normalization
 #-------------------------------------------------------------------------
 
-def is_sentence_end(c):
-    """
-    The following characters are considered to be sentence endings for our
-    normalization.
-    """
-    return c in ".!?"
+# Character classes as sets, so a membership test is a single hash lookup
+# instead of a scan through a string.
+#
+# The following characters are considered to be sentence endings for our
+# normalization.
+sentenceEnds = frozenset(".!?")
+wordLetters = frozenset(string.ascii_letters)
 
 
-def is_sentence_break(c):
-    """
-    The following characters are considered to be sentence breaks for our
-    normalization of long sentences.
-    """
-    return c in string.punctuation
+# The only things that matter for finding sentence ends are the words
+# (runs of letters) and the punctuation. Everything else is skipped by the
+# regex engine, so we don't have to loop over each character. Note that
+# words continue over line joins, as they always have, and that any
+# punctuation is considered a sentence break for our normalization of long
+# sentences.
+sentenceTokens = re.compile("[%s]+(?:\n[%s]+)*|[%s]" % \
+        (string.ascii_letters, string.ascii_letters, re.escape(string.punctuation)))
 
 
-def is_sentence_done(sentence):
-    """
-    Detect whether the sentence is done
+def split_sentences(paragraph,wordLength=0):
     """
-    global longSentenceLength
-
-    if len(sentence) > 0:
-        if is_sentence_end(sentence[-1]):
-            return True
-        else:
-            if len(sentence) >= longSentenceLength:
-                if is_sentence_break(sentence[-1]):
-                    return True
-    return False
+    Split a paragraph, whose lines are joined by newlines, into sentences.
+    wordLength is the length of the word that the previous paragraph ended
+    with.
 
-
-def flush_sentence(fout,forceNewLine = False):
-    """
-    Flush the sentence buffer.
+    Returns the list of sentences, and the length of the word this
+    paragraph ends with.
     """
-    global sentenceBuf
-    global lastWordLength
-
-    lastWordLength = 0
-    l = sentenceBuf.lstrip()
-    l = fix_ff_problem(l)
-    fout.write(l)
-    if forceNewLine or (sentenceBuf != ""):
-        fout.write("\n")
-    sentenceBuf = ""
-
+    global longSentenceLength
 
-def normalize_text(fin,fout):
-    """
-    Normalize the lines read from fin, and output to fout, which
-    are file handles.
-    """
-    global sentenceBuf
-    global lastWordLength
+    # This loop runs for every word and punctuation mark, so we use
+    # locals rather than globals or helper functions.
+    letters = wordLetters
+    ends = sentenceEnds
+    longLength = longSentenceLength
 
-    sentenceBuf = ""    # stores unfinished sentences
-    wordLength = 0
+    sentences = []
+    start = 0
     lastWordLength = 0
-    skipEnds = False
-
-    # Alternatively, we could use xreadlines, if the files are really
-    # really huge.
-    for l in fin.readlines():
+    for m in sentenceTokens.finditer(paragraph):
+        token = m.group()
+        if token[0] in letters:
+            # Some admin to know how long the last word was.
+            if m.start() > 0:
+                wordLength = 0
+            wordLength += len(token) - token.count("\n")
+            lastWordLength = wordLength
+            continue
+
+        # Any other token is a sentence break. Is the sentence done?
+        end = m.end()
+        if token in ends or end - start >= longLength:
+            # If the last word is only a single character,
+            # it's assumed that the punctuation does not
+            # refer to a sentence end.
+            if lastWordLength != 1:
+                # Sentence has ended, so split it off.
+                sentences.append(paragraph[start:end])
+                start = end
+                lastWordLength = 0
+                # A new line directly after the sentence end does not
+                # count towards the length of the next one.
+                if paragraph.startswith("\n", start):
+                    start += 1
+
+    if start < len(paragraph):
+        sentences.append(paragraph[start:])
+    if paragraph != "" and not paragraph[-1] in letters:
+        wordLength = 0
+    return (sentences,wordLength)
+
+
+class Normalizer:
+    """
+    Normalizes the lines that are fed to it, and outputs to fout, which is
+    a file handle.
+    """
+
+    def __init__(self,fout):
+        self.fout = fout
+        self.paragraph = []     # stores the lines of unfinished paragraphs
+        self.wordLength = 0     # length of the word it ended with
+        self.skipEnds = False
+        self.outLines = []      # output lines of the paragraph
+
+    def feed(self,l):
+        """
+        Process the next line.
+        """
         # Cut of spacing from both ends
         ls = l.strip()
-        
+
         # Empty line or not?
         if ls == "":
             # This occurs when there is an empty line.
-            # We flush the sentence, and force a newline.
+            # We flush the paragraph, and force a newline.
             #
             # Any further additional empty lines have no effect,
             # which is enforced by skipEnds.
-            if not skipEnds:
-                flush_sentence(fout)
-                flush_sentence(fout,True)
-                skipEnds = True
+            if not self.skipEnds:
+                self.flush(True)
+                self.skipEnds = True
         else:
             # The file line is not empty, so this is some sort of
             # paragraph
-            skipEnds = False
-            if sentenceBuf != "":
-                if not sentenceBuf[-1] in string.whitespace:
-                    sentenceBuf += " "
-
-            for c in ls:
-                # Append the character to the current buffer.
-                sentenceBuf += c
-
-                # Some admin to know how long the last word was.
-                if c in string.ascii_letters:
-                    wordLength += 1
-                    lastWordLength = wordLength
-                else:
-                    wordLength = 0
-
-                if is_sentence_done(sentenceBuf):
-                    # If the last word is only a single character,
-                    # it's assumed that the punctuation does not
-                    # refer to a sentence end.
-                    if lastWordLength != 1:
-                        # Sentence has ended, so flush it.
-                        # We should skip any spacing directly after
-                        # the sentence end mark.
-                        flush_sentence(fout)
-
-    flush_sentence(fout)
+            self.skipEnds = False
+            self.paragraph.append(ls)
+
+    def flush(self,forceNewLine=False):
+        """
+        Flush the paragraph buffer, writing its sentences one per line.
+        """
+        (sentences,self.wordLength) = split_sentences("\n".join(self.paragraph),self.wordLength)
+        outLines = self.outLines
+        for sentence in sentences:
+            # We should skip any spacing directly after the sentence end mark.
+            outLines.append(fix_ff_problem(sentence.lstrip().replace("\n"," ")) + "\n")
+        if forceNewLine:
+            outLines.append("\n")
+
+        # The whole paragraph is written in one go.
+        self.fout.writelines(outLines)
+        outLines.clear()
+        self.paragraph.clear()
+
+
+def normalize_text(fin,fout):
+    """
+    Normalize the lines read from fin, and output to fout, which
+    are file handles.
+    """
+    normalizer = Normalizer(fout)
+
+    # Iterate over the file instead of reading all lines first, which
+    # only keeps the current paragraph in memory. Text files and pipes
+    # are opened with universal newlines, so any '\r\n' or '\r' line ends
+    # have already been turned into '\n' for us.
+    for l in fin:
+        normalizer.feed(l)
+
+    normalizer.flush()
     fout.flush()
 
 
@@ -322,47 +422,87 @@ def normalize_text(fin,fout):
 # 3. Conversions from format A to B
 #-------------------------------------------------------------------------
 
-def ps_to_pdf(filename,prefix=""):
+def ps_to_pdf(filename,prefix="",origname=None):
     """
     ps to pdf conversion
     """
     prg = "ps2pdf"
     notfound = "Could not find 'ps2pdf', which is needed for ps to pdf conversion." 
-    (fout,output) = apply_command_temp(prg,"",notfound,filename,prefix,".pdf")
+    (fout,output) = apply_command_temp(prg,"",notfound,filename,prefix,".pdf",origname)
     return fout
 
 
-def pdf_to_text(filename,prefix=""):
+def pdf_to_text_notfound():
     """
-    pdf to text conversion
+    Error message for when pdftotext is missing
     """
-    global pdftotextProgram,pdftotextOptions
+    global pdftotextProgram
 
-    notfound = """\
+    return """\
 Could not find '%s', which is needed for pdf to text conversion.
 %s is part of the 'xPdf' suite of programs, obtainable at:
   http://www.foolabs.com/xpdf/
 """ % (pdftotextProgram,pdftotextProgram)
-    (fout,output) = apply_command_temp(pdftotextProgram,pdftotextOptions,notfound,filename,prefix,".txt")
+
+
+def pdf_to_text(filename,prefix="",origname=None):
+    """
+    pdf to text conversion
+    """
+    global pdftotextProgram,pdftotextOptions
+
+    notfound = pdf_to_text_notfound()
+    (fout,output) = apply_command_temp(pdftotextProgram,pdftotextOptions,notfound,filename,prefix,".txt",origname)
     return fout
 
 
-def normalize_anything(filename,fout=sys.stdout):
+def pdf_to_text_stream(filename):
+    """
+    pdf to text conversion, where the text is read from a pipe instead of
+    a temporary file.
+
+    Returns (process,errorlog); the text is in the stdout of the process,
+    and its messages go to the errorlog file handle, so that they are only
+    shown on failure, as with pdf_to_text.
+    """
+    global pdftotextProgram,pdftotextOptions
+
+    if not is_command_available(pdftotextProgram):
+        print("Error: %s" % pdf_to_text_notfound())
+        sys.exit(1)
+
+    # A '-' as output file makes pdftotext write to stdout
+    argv = shlex.split(pdftotextProgram) + shlex.split(pdftotextOptions) + [filename,"-"]
+    errlog = tempfile.TemporaryFile(mode="w+")
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=errlog, encoding="utf-8")
+    return (proc,errlog)
+
+
+def normalize_anything(filename,fout=sys.stdout,stream=False):
     """
     This function takes any file type and tries to apply converters
     until we can finall churn out normalized text.
+
+    If stream is set, the text of pdf files is normalized directly from
+    the output of pdftotext, without going through a temporary file.
     """
+    origname = filename
     prefix = make_prefix(filename)
     filetype = get_filetype(filename)
 
     # Iterate until we have text
     temphandle = None
     fhandle = None
+    proc = None
     while filetype != "txt":
-        if filetype == "pdf":
-            fhandle = pdf_to_text(filename,prefix=prefix)
+        if filetype == "pdf" and stream:
+            (proc,errlog) = pdf_to_text_stream(filename)
+            fhandle = proc.stdout
+            break
+        elif filetype == "pdf":
+            fhandle = pdf_to_text(filename,prefix=prefix,origname=origname)
         elif filetype == "ps":
-            fhandle = ps_to_pdf(filename,prefix=prefix)
+            fhandle = ps_to_pdf(filename,prefix=prefix,origname=origname)
         else:
             print("Error: Don't know how to handle file type '%s'" % filetype)
             sys.exit(1)
@@ -378,7 +518,20 @@ def normalize_anything(filename,fout=sys.stdout):
         fhandle = open(filename,'r')
 
     # Now fhandle is considered text
-    normalize_text(fhandle,fout)
+    if not proc:
+        normalize_text(fhandle,fout)
+        return
+
+    try:
+        normalize_text(fhandle,fout)
+    finally:
+        fhandle.close()
+        proc.wait()
+    errlog.seek(0)
+    output = errlog.read().rstrip("\n")
+    errlog.close()
+    if proc.returncode != 0:
+        conversion_failed(pdftotextProgram,origname,proc.returncode,output)
 
 
 def normalize_anything_tempfile(filename):
@@ -387,10 +540,29 @@ def normalize_anything_tempfile(filename):
     """
     prefix = make_prefix(filename)
     fout = tempfile.NamedTemporaryFile(mode="w+", suffix=".txt", prefix=prefix)
-    normalize_anything(filename,fout)
+    normalize_anything(filename,fout,stream=True)
     return fout
 
 
+def normalize_file(filename,outname):
+    """
+    Normalize anything into the file outname. The result is written to
+    a file next to it first, so outname is only created (or replaced) once
+    the conversion has succeeded.
+    """
+    partname = outname + ".part"
+    fout = open(partname,"w")
+    try:
+        normalize_anything(filename,fout,stream=True)
+        fout.close()
+        os.replace(partname,outname)
+    except BaseException:
+        fout.close()
+        os.remove(partname)
+        raise
+    return outname
+
+
 #-------------------------------------------------------------------------
 # 4. High-level commands
 #-------------------------------------------------------------------------
@@ -401,17 +573,19 @@ def view_diff(fnleft,fnright):
     found.
     """
     global diffViewers
-    global diffViewerPrefix
+    global diffViewerPrefix, diffViewerMatches
 
-    fleft  = normalize_anything_tempfile(fnleft)
-    fright = normalize_anything_tempfile(fnright)
+    # The conversions mostly wait for external programs, so we can
+    # simply do both at the same time.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as ex:
+        (fleft,fright) = ex.map(normalize_anything_tempfile,(fnleft,fnright))
 
     viewers = []
     if diffViewerPrefix != "":
         # Attempt to use the prefix as a program (overrides defaults)
         viewers = [diffViewerPrefix]
         # Also add filtered known ones
-        viewers += filter(lambda s:s.startswith(diffViewerPrefix),diffViewers)
+        viewers += diffViewerMatches
     # Add known ones
     viewers += diffViewers
 
@@ -422,8 +596,7 @@ def view_diff(fnleft,fnright):
         print(estr)
         sys.exit(1)
 
-    cmd = "%s \"%s\" \"%s\"" % (prg,fleft.name,fright.name)
-    out = subprocess.getoutput(cmd)
+    out = get_output(shlex.split(prg) + [fleft.name,fright.name])
     # Also print the result (e.g. for programs like diff that send
     # output to stdout)
     print(out)
@@ -432,6 +605,32 @@ def view_diff(fnleft,fnright):
     fright.close()
 
 
+def normalize_files(filenames,outdir,jobs=0):
+    """
+    Normalize many files, writing the result for e.g. 'paper.pdf' to
+    'paper_normalized.txt' in outdir. The files are independent, so they
+    are spread over up to jobs processes (0 means one per CPU).
+    """
+    outnames = []
+    for fn in filenames:
+        if not os.path.isfile(fn) or not os.access(fn, os.R_OK):
+            print("Error: Could not read the file '%s'" % fn)
+            sys.exit(1)
+        outname = os.path.join(outdir, make_prefix(fn) + "normalized.txt")
+        if outname in outnames:
+            print("Error: more than one file would be normalized into '%s'" % outname)
+            sys.exit(1)
+        if os.path.abspath(outname) == os.path.abspath(fn):
+            print("Error: normalizing '%s' would overwrite it" % fn)
+            sys.exit(1)
+        outnames.append(outname)
+
+    workers = min(jobs or os.cpu_count() or 1, len(filenames))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as ex:
+        for outname in ex.map(normalize_file,filenames,outnames):
+            print(outname)
+
+
 def display_help():
     """
     Program manual
@@ -444,6 +643,7 @@ PRG version %s
 Copyright 2007 Cas Cremers
 
 Usage: PRG [switches] <file1> [<file2>]
+       PRG --jobs <n> [--outdir <dir>] <file1> [<file2> ...]
 
   View the difference between two files, or output a normalized version
   of the text in a single file.
@@ -455,7 +655,14 @@ Switches:
        the first available diffviewer from the list:
         %s
        that starts with <prefix>.
-""" % (progVersion, ", ".join(get_viewer_list()))
+  -j <n>, --jobs <n>
+       Normalize any number of files, using up to <n> processes in
+       parallel (0 means one per CPU). The normalized text of a file such
+       as 'paper.pdf' is written to 'paper_normalized.txt'.
+  -o <dir>, --outdir <dir>
+       Directory for the files normalized with --jobs (default: the
+       current directory). Only applies to --jobs.
+""" % (progVersion, ", ".join(diffViewerNames))
     print(helpstr.replace("PRG", progName))
 
 
@@ -467,10 +674,13 @@ if __name__ == "__main__":
     """
     Main code
     """
-    global diffViewerPrefix
+    global diffViewerPrefix, diffViewerMatches
 
     args = sys.argv[1:]
     diffViewerPrefix = ""
+    diffViewerMatches = []      # known viewers starting with the prefix
+    jobs = None
+    outdir = None
 
     # No arguments, show help
     if len(args) == 0:
@@ -491,16 +701,39 @@ if __name__ == "__main__":
                 print("Error: Diff viewer preference requires a string prefix argument")
                 sys.exit(1)
             diffViewerPrefix = args[1]
-            if len(list(filter(lambda s:s.startswith(diffViewerPrefix),get_viewer_list()))) == 0:
+            diffViewerMatches = [c for c in diffViewers if (c.split())[0].startswith(diffViewerPrefix)]
+            if len(diffViewerMatches) == 0:
                 if not is_command_available(diffViewerPrefix):
                     print("Error: program '%s' not found, and no viewer from the list %s starts with '%s'" %
-                          (diffViewerPrefix, get_viewer_list(), diffViewerPrefix))
+                          (diffViewerPrefix, ", ".join(diffViewerNames), diffViewerPrefix))
                     sys.exit(1)
             args = args[2:]
 
+        elif optcmd in ["-j","--jobs"]:
+            # Batch mode with a number of processes
+            if len(args) < 2 or not args[1].isdigit():
+                print("Error: Batch mode requires a number of processes as argument")
+                sys.exit(1)
+            jobs = int(args[1])
+            args = args[2:]
+
+        elif optcmd in ["-o","--outdir"]:
+            # Output directory for batch mode
+            if len(args) < 2 or not os.path.isdir(args[1]):
+                print("Error: Output directory requires an existing directory as argument")
+                sys.exit(1)
+            outdir = args[1]
+            args = args[2:]
+
         else:
             # Default mode: 1 argument is normalize, 2 is diff
-            if len(args) == 1:
+            if jobs is not None:
+                normalize_files(args,outdir or ".",jobs)
+                sys.exit(0)
+            elif outdir is not None:
+                print("Error: An output directory can only be used with --jobs")
+                sys.exit(1)
+            elif len(args) == 1:
                 normalize_anything(args[0])
                 sys.exit(0)
             elif len(args) == 2: